@@ -7,113 +7,255 @@ Usage:
     python admin-server.py
 
 Then open http://localhost:5000/admin
+
+For longer sessions run it under Hypercorn instead of the debug server:
+    hypercorn --bind 0.0.0.0:5000 admin-server:app
+Keep to a single Hypercorn worker: background removal jobs and previews
+live in process memory.
+
+Set REMBG_MODEL to use a different rembg model (default: u2net),
+e.g. isnet-general-use or the smaller u2netp. Install rembg[gpu] to
+run background removal on CUDA. REMBG_WORKERS sets how many background
+removal processes run in parallel (default: 2). Card storage, uploads and
+background removal live in card_store.py, shared with scripts/.
 """
 
-import os
-import json
 import uuid
 import io
-import base64
+import os
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, send_from_directory
-from flask_cors import CORS
+from quart import Quart, Response, request, jsonify, send_from_directory
+from quart_cors import cors
 from PIL import Image
-from rembg import remove
-import requests
+from servestatic import ServeStaticASGI
+from card_store import (
+    DATA_FILE,
+    Store,
+    clamp_box,
+    crop_and_remove_backgrounds,
+    generate_card_id,
+    predict_masks,
+)
+
+app = cors(Quart(__name__, static_folder='.', template_folder='.'), allow_origin="*")
+
 
-app = Flask(__name__, static_folder='.', template_folder='.')
-CORS(app)
+class AppStatic(ServeStaticASGI):
+    """ServeStatic, except for cards.json, which is left to the Quart app."""
+
+    def find_file(self, url):
+        if url == '/data/cards.json':
+            return None
+        return super().find_file(url)
+
+
+# Static files are served by ServeStatic, before requests reach the Quart app.
+# autorefresh looks each file up per request, so edited files and new uploads
+# are served with their current contents and length. max_age=0 makes the
+# browser revalidate (a cheap 304 when unchanged) instead of holding on to an
+# old game.js or styles.css.
+app.asgi_app = AppStatic(app.asgi_app, root=app.root_path, max_age=0, autorefresh=True)
 
 # Constants
-DATA_FILE = Path(__file__).parent / "data" / "cards.json"
+REMBG_WORKERS = int(os.environ.get("REMBG_WORKERS", "2"))
 UPLOADS_DIR = Path(__file__).parent / "uploads"
-PROCESSED_DIR = Path(__file__).parent / "processed"
+PREVIEW_TTL = 30 * 60  # seconds an unconfirmed preview or job is kept in memory
+MAX_BATCH = 16  # most cards accepted in one batch request
 
 # Ensure directories exist
 UPLOADS_DIR.mkdir(exist_ok=True)
-PROCESSED_DIR.mkdir(exist_ok=True)
 
+# cards.json and Cloudflare uploads, shared with the card scripts
+store = Store()
 
-def load_cards():
-    """Load existing cards from JSON."""
-    if DATA_FILE.exists():
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    return {"cards": []}
+# Background removal runs in worker processes so it neither blocks the event
+# loop nor holds the GIL; requests get a job id to poll instead. The pool is
+# started by start_rembg_workers.
+_REMBG_POOL = None
 
+# Background removal jobs: job_id -> (created_at, words, pool, future)
+_JOBS = {}
 
-def save_cards(data):
-    """Save cards to JSON."""
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+# Processed cards waiting for confirmation:
+# token -> (created_at, preview_png)
+_PREVIEW_CACHE = {}
 
 
-def upload_to_cloudflare(image_bytes, filename):
-    """Upload image to Cloudflare Images."""
-    account_id = os.environ.get("CLOUDFLARE_ACCOUNT_ID")
-    api_token = os.environ.get("CLOUDFLARE_API_TOKEN")
+def warm_up_rembg_worker():
+    """Worker initializer: load the rembg session and run one dummy inference
+    so ONNX Runtime builds its execution plan and allocates its memory before
+    the first real request."""
+    predict_masks([Image.new('RGB', (320, 320))])
 
-    if not account_id or not api_token:
-        raise ValueError("CLOUDFLARE_ACCOUNT_ID and CLOUDFLARE_API_TOKEN must be set")
 
-    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/images/v1"
+def start_rembg_pool():
+    """Create the background removal pool; each worker warms itself up."""
+    return ProcessPoolExecutor(max_workers=REMBG_WORKERS, initializer=warm_up_rembg_worker)
 
-    headers = {
-        "Authorization": f"Bearer {api_token}"
-    }
 
-    files = {
-        "file": (filename, image_bytes, "image/png")
-    }
+@app.before_serving
+async def start_rembg_workers():
+    """Start every worker now rather than on first use.
+
+    The pool only spawns a process when a job finds no idle worker, so
+    submitting one no-op per worker brings them all up. If warming up fails
+    (e.g. the model download or CUDA init), the server still starts: the
+    broken pool is rebuilt when a job hits it, and face cards, listing and
+    deletes don't need it.
+    """
+    global _REMBG_POOL
+    _REMBG_POOL = start_rembg_pool()
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(*(
+            loop.run_in_executor(_REMBG_POOL, os.getpid) for _ in range(REMBG_WORKERS)
+        ))
+    except Exception:
+        app.logger.exception("Background removal workers failed to start")
 
-    response = requests.post(url, headers=headers, files=files)
 
-    if response.status_code != 200:
-        raise Exception(f"Cloudflare upload failed: {response.text}")
+@app.after_serving
+async def close_http_client():
+    await store.aclose()
 
-    result = response.json()
-    if not result.get("success"):
-        raise Exception(f"Cloudflare upload failed: {result.get('errors')}")
 
-    # Return the delivery URL with medium variant (good for cards - ~500px)
-    image_id = result["result"]["id"]
-    delivery_hash = os.environ.get("CLOUDFLARE_DELIVERY_HASH", "3oZsG34qPq3SIXQhl47vqA")
+@app.after_serving
+async def stop_rembg_workers():
+    _REMBG_POOL.shutdown(wait=False, cancel_futures=True)
 
-    # Use 'medium' variant for optimal card size (retina-friendly but not excessive)
-    return f"https://imagedelivery.net/{delivery_hash}/{image_id}/medium"
 
+class CardRequestError(Exception):
+    """Invalid card request, reported to the client with an HTTP status."""
 
-def generate_card_id(word, card_type):
-    """Generate a unique card ID."""
-    short_uuid = str(uuid.uuid4())[:8]
-    prefix = "face-" if card_type == "face" else ""
-    return f"{prefix}{word.lower()}-{short_uuid}"
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_number_card(data):
+    """Validate a number card request; returns (word, image_path, crop_box)."""
+    required = ['filename', 'word', 'cropX', 'cropY', 'cropWidth', 'cropHeight']
+    for field in required:
+        if field not in data:
+            raise CardRequestError(f"Missing field: {field}")
+
+    temp_path = UPLOADS_DIR / data['filename']
+    if not temp_path.exists():
+        raise CardRequestError("Image not found", 404)
+
+    word = data['word'].upper()
+    crop_x = int(data['cropX'])
+    crop_y = int(data['cropY'])
+    crop_width = int(data['cropWidth'])
+    crop_height = int(data['cropHeight'])
+    box = (crop_x, crop_y, crop_x + crop_width, crop_y + crop_height)
+
+    # Boxes are clipped to the image when cropping; reject any that would
+    # leave nothing (only the header is read here)
+    with Image.open(temp_path) as img:
+        left, upper, right, lower = clamp_box(box, img.size)
+    if right <= left or lower <= upper:
+        raise CardRequestError("Crop area is outside the image")
+
+    return word, temp_path, box
+
+
+def encode_png(image, **params):
+    """Encode an image as PNG bytes."""
+    img_bytes = io.BytesIO()
+    image.save(img_bytes, format='PNG', **params)
+    return img_bytes.getvalue()
+
+
+def process_number_cards(crops):
+    """Worker job: crop, remove backgrounds and encode each card's preview.
+
+    Returns a preview PNG per crop, so only bytes cross the process boundary.
+    The full-compression PNG for upload is made from it once the card is
+    confirmed.
+    """
+    results = []
+    for image in crop_and_remove_backgrounds(crops):
+        # The preview is only shown locally, so favour encode speed over size
+        results.append(encode_png(image, compress_level=1))
+    return results
+
+
+def recompress_png(png_bytes):
+    """Re-encode PNG bytes at the default compression level (lossless)."""
+    with Image.open(io.BytesIO(png_bytes)) as image:
+        return encode_png(image)
+
+
+def _drop_expired(cache):
+    now = time.time()
+    for key, entry in list(cache.items()):
+        if now - entry[0] > PREVIEW_TTL:
+            del cache[key]
+
+
+def restart_rembg_pool(broken_pool):
+    """Replace the pool after a worker died, unless that's already been done."""
+    global _REMBG_POOL
+    if _REMBG_POOL is broken_pool:
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+        _REMBG_POOL = start_rembg_pool()
+
+
+def submit_job(words, crops):
+    """Queue a background removal job; returns its id."""
+    _drop_expired(_JOBS)
+    pool = _REMBG_POOL
+    try:
+        future = pool.submit(process_number_cards, crops)
+    except BrokenProcessPool:
+        restart_rembg_pool(pool)
+        raise CardRequestError("Background removal workers crashed, please try again", 503)
+    job_id = uuid.uuid4().hex
+    _JOBS[job_id] = (time.time(), words, pool, future)
+    return job_id
+
+
+def store_preview(preview_png):
+    """Keep a processed card in memory until confirmed; returns its token."""
+    _drop_expired(_PREVIEW_CACHE)
+    token = uuid.uuid4().hex
+    _PREVIEW_CACHE[token] = (time.time(), preview_png)
+    return token
 
 
 # Routes
 @app.route('/')
-def index():
-    return send_from_directory('.', 'admin.html')
+async def index():
+    return await send_from_directory(app.root_path, 'admin.html')
 
 
-@app.route('/<path:path>')
-def static_files(path):
-    return send_from_directory('.', path)
+@app.route('/data/cards.json')
+async def cards_json():
+    """Serve cards.json uncached; the server rewrites it as cards change."""
+    response = await send_from_directory(DATA_FILE.parent, DATA_FILE.name)
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route('/api/cards', methods=['GET'])
-def get_cards():
+async def get_cards():
     """Get all cards."""
-    return jsonify(load_cards())
+    return jsonify({"cards": await store.cards_async()})
 
 
 @app.route('/api/upload-temp', methods=['POST'])
-def upload_temp():
+async def upload_temp():
     """Upload image temporarily for preview/cropping."""
-    if 'image' not in request.files:
+    files = await request.files
+    if 'image' not in files:
         return jsonify({"error": "No image provided"}), 400
 
-    file = request.files['image']
+    file = files['image']
     if file.filename == '':
         return jsonify({"error": "No file selected"}), 400
 
@@ -122,11 +264,13 @@ def upload_temp():
     temp_filename = f"temp_{uuid.uuid4().hex[:8]}{ext}"
     temp_path = UPLOADS_DIR / temp_filename
 
-    file.save(temp_path)
-
-    # Get image dimensions
-    img = Image.open(temp_path)
+    # Get image dimensions from the upload stream (Pillow only parses the
+    # header) rather than re-opening the file after it's written
+    img = Image.open(file.stream)
     width, height = img.size
+    file.stream.seek(0)
+
+    await file.save(temp_path)
 
     return jsonify({
         "filename": temp_filename,
@@ -137,117 +281,172 @@ def upload_temp():
 
 
 @app.route('/api/process-number-card', methods=['POST'])
-def process_number_card():
-    """Process a number card: crop, remove background, upload to Cloudflare."""
-    data = request.json
+async def process_number_card():
+    """Queue a number card for cropping and background removal.
 
-    required = ['filename', 'word', 'cropX', 'cropY', 'cropWidth', 'cropHeight']
-    for field in required:
-        if field not in data:
-            return jsonify({"error": f"Missing field: {field}"}), 400
+    Returns a job id; poll /api/job/<id> for the preview.
+    """
+    data = await request.get_json()
 
-    temp_path = UPLOADS_DIR / data['filename']
-    if not temp_path.exists():
-        return jsonify({"error": "Image not found"}), 404
+    try:
+        word, temp_path, box = parse_number_card(data)
+    except CardRequestError as e:
+        return jsonify({"error": str(e)}), e.status
 
-    word = data['word'].upper()
-    crop_x = int(data['cropX'])
-    crop_y = int(data['cropY'])
-    crop_width = int(data['cropWidth'])
-    crop_height = int(data['cropHeight'])
+    try:
+        job_id = submit_job([word], [(temp_path, box)])
+    except CardRequestError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    return jsonify({
+        "success": True,
+        "jobId": job_id
+    }), 202
+
+
+@app.route('/api/process-number-cards-batch', methods=['POST'])
+async def process_number_cards_batch():
+    """Queue several number cards, sharing one background-removal model run.
+
+    Expects {"cards": [...]} where each entry has the same fields as
+    process-number-card, up to MAX_BATCH cards. Returns a single job id.
+    """
+    data = await request.get_json()
+
+    if not data or not data.get('cards'):
+        return jsonify({"error": "Missing field: cards"}), 400
+
+    if len(data['cards']) > MAX_BATCH:
+        return jsonify({"error": f"At most {MAX_BATCH} cards per batch"}), 400
+
+    parsed = []
+    for index, card in enumerate(data['cards']):
+        try:
+            parsed.append(parse_number_card(card))
+        except CardRequestError as e:
+            return jsonify({"error": f"Card {index}: {e}"}), e.status
 
     try:
-        # Step 1: Open and crop
-        img = Image.open(temp_path)
-        if img.mode not in ('RGB', 'RGBA'):
-            img = img.convert('RGBA')
+        job_id = submit_job(
+            [word for word, _, _ in parsed],
+            [(temp_path, box) for _, temp_path, box in parsed]
+        )
+    except CardRequestError as e:
+        return jsonify({"error": str(e)}), e.status
 
-        cropped = img.crop((crop_x, crop_y, crop_x + crop_width, crop_y + crop_height))
+    return jsonify({
+        "success": True,
+        "jobId": job_id
+    }), 202
 
-        # Step 2: Remove background
-        processed = remove(cropped)
 
-        # Save preview
-        preview_filename = f"{word.lower()}_preview.png"
-        preview_path = PROCESSED_DIR / preview_filename
-        processed.save(preview_path)
+@app.route('/api/job/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    """Poll a background removal job; once done, returns a preview per card."""
+    job = _JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
 
-        # Convert to base64 for preview
-        img_bytes = io.BytesIO()
-        processed.save(img_bytes, format='PNG')
-        img_bytes.seek(0)
-        preview_base64 = base64.b64encode(img_bytes.getvalue()).decode('utf-8')
+    _, words, pool, future = job
+    if not future.done():
+        return jsonify({"status": "pending"})
 
-        return jsonify({
-            "success": True,
-            "preview": f"data:image/png;base64,{preview_base64}",
-            "previewPath": f"processed/{preview_filename}",
+    del _JOBS[job_id]
+    try:
+        processed = future.result()
+    except BrokenProcessPool:
+        restart_rembg_pool(pool)
+        return jsonify({"error": "Background removal worker crashed, please try again"}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    results = []
+    for word, preview_png in zip(words, processed):
+        token = store_preview(preview_png)
+        results.append({
+            "token": token,
+            "previewUrl": f"/api/preview/{token}",
             "word": word
         })
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return jsonify({
+        "status": "done",
+        "cards": results
+    })
+
+
+@app.route('/api/preview/<token>', methods=['GET'])
+async def get_preview(token):
+    """Serve a processed preview as a raw PNG."""
+    preview = _PREVIEW_CACHE.get(token)
+    if preview is None:
+        return jsonify({"error": "Preview not found"}), 404
+
+    _, preview_png = preview
+    return Response(preview_png, mimetype='image/png', headers={"Cache-Control": "no-store"})
 
 
 @app.route('/api/confirm-number-card', methods=['POST'])
-def confirm_number_card():
+async def confirm_number_card():
     """Confirm and upload number card to Cloudflare."""
-    data = request.json
+    data = await request.get_json()
 
-    if 'word' not in data:
-        return jsonify({"error": "Missing word"}), 400
+    for field in ('word', 'token'):
+        if field not in data:
+            return jsonify({"error": f"Missing field: {field}"}), 400
 
     word = data['word'].upper()
-    preview_path = PROCESSED_DIR / f"{word.lower()}_preview.png"
+    token = data['token']
 
-    if not preview_path.exists():
+    # Take the preview so a double-click can't upload the same card twice
+    preview = _PREVIEW_CACHE.pop(token, None)
+    if preview is None:
         return jsonify({"error": "Preview not found. Process the card first."}), 404
 
+    _, preview_png = preview
+
     try:
-        # Read the processed image
-        with open(preview_path, 'rb') as f:
-            img_bytes = f.read()
+        img_bytes = await asyncio.get_running_loop().run_in_executor(None, recompress_png, preview_png)
 
         # Upload to Cloudflare
         card_id = generate_card_id(word, "number")
         filename = f"{card_id}.png"
-        image_url = upload_to_cloudflare(img_bytes, filename)
+        image_url = await store.upload_image_async(img_bytes, filename)
 
         # Update JSON
-        cards_data = load_cards()
         new_card = {
             "id": card_id,
             "word": word,
             "imageUrl": image_url,
             "type": "number"
         }
-        cards_data["cards"].append(new_card)
-        save_cards(cards_data)
-
-        # Clean up temp files
-        preview_path.unlink(missing_ok=True)
+        total_cards = await store.add_card_async(new_card)
 
         return jsonify({
             "success": True,
             "card": new_card,
-            "totalCards": len(cards_data["cards"])
+            "totalCards": total_cards
         })
 
     except Exception as e:
+        # Put the preview back so the upload can be retried
+        _PREVIEW_CACHE[token] = preview
         return jsonify({"error": str(e)}), 500
 
 
 @app.route('/api/process-face-card', methods=['POST'])
-def process_face_card():
+async def process_face_card():
     """Process a face card: upload directly to Cloudflare (no cropping/bg removal)."""
-    if 'image' not in request.files:
+    files = await request.files
+    form = await request.form
+    if 'image' not in files:
         return jsonify({"error": "No image provided"}), 400
 
-    if 'word' not in request.form:
+    if 'word' not in form:
         return jsonify({"error": "No word provided"}), 400
 
-    file = request.files['image']
-    word = request.form['word'].upper()
+    file = files['image']
+    word = form['word'].upper()
 
     if file.filename == '':
         return jsonify({"error": "No file selected"}), 400
@@ -259,23 +458,21 @@ def process_face_card():
         # Upload to Cloudflare
         card_id = generate_card_id(word, "face")
         filename = f"{card_id}.png"
-        image_url = upload_to_cloudflare(img_bytes, filename)
+        image_url = await store.upload_image_async(img_bytes, filename)
 
         # Update JSON
-        cards_data = load_cards()
         new_card = {
             "id": card_id,
             "word": word,
             "imageUrl": image_url,
             "type": "face"
         }
-        cards_data["cards"].append(new_card)
-        save_cards(cards_data)
+        total_cards = await store.add_card_async(new_card)
 
         return jsonify({
             "success": True,
             "card": new_card,
-            "totalCards": len(cards_data["cards"])
+            "totalCards": total_cards
         })
 
     except Exception as e:
@@ -283,21 +480,15 @@ def process_face_card():
 
 
 @app.route('/api/delete-card/<card_id>', methods=['DELETE'])
-def delete_card(card_id):
+async def delete_card(card_id):
     """Delete a card from the JSON (doesn't delete from Cloudflare)."""
-    cards_data = load_cards()
-
-    original_count = len(cards_data["cards"])
-    cards_data["cards"] = [c for c in cards_data["cards"] if c["id"] != card_id]
-
-    if len(cards_data["cards"]) == original_count:
+    total_cards = await store.delete_card_async(card_id)
+    if total_cards is None:
         return jsonify({"error": "Card not found"}), 404
 
-    save_cards(cards_data)
-
     return jsonify({
         "success": True,
-        "totalCards": len(cards_data["cards"])
+        "totalCards": total_cards
     })
 
 
@@ -0,0 +1,378 @@
+"""
+Shared card storage and image processing for the admin server and scripts.
+
+Store keeps cards.json in memory and uploads images to Cloudflare Images over
+pooled HTTP connections. Background removal loads its rembg model once per
+process.
+
+rembg, onnxruntime and numpy are imported on first background removal, and
+httpx only by upload_image_async, so scripts that just upload don't load the
+ML stack.
+
+Environment variables:
+    CLOUDFLARE_ACCOUNT_ID, CLOUDFLARE_API_TOKEN (required for uploads)
+    CLOUDFLARE_DELIVERY_HASH
+    REMBG_MODEL (default: u2net, e.g. isnet-general-use or u2netp)
+"""
+
+import asyncio
+import math
+import os
+import threading
+import uuid
+from pathlib import Path
+
+import orjson
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from cykooz.resizer import FilterType, ResizeAlg, Resizer, ResizeOptions
+except ImportError:  # optional SIMD resizer; falls back to Pillow
+    Resizer = None
+
+# Constants
+DATA_FILE = Path(__file__).parent / "data" / "cards.json"
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2net")
+REMBG_MAX_SIDE = 1024  # the model runs at 320px, so larger inputs only cost time
+U2NET_MODELS = ("u2net", "u2netp", "u2net_human_seg")
+CROP_MIN_SIDE = 1600  # JPEGs are decoded at reduced scale while crops stay this big
+CLOUDFLARE_RETRIES = 3
+CLOUDFLARE_RETRY_STATUSES = (502, 503, 504)
+
+# Reused across uploads so the TLS connection to Cloudflare stays open
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(
+        # Uploads aren't idempotent: retry failed connects and gateway errors,
+        # but not read errors, when Cloudflare may already have the image
+        connect=CLOUDFLARE_RETRIES,
+        read=0,
+        status=CLOUDFLARE_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=CLOUDFLARE_RETRY_STATUSES,
+        allowed_methods=None,  # uploads are POSTs, which urllib3 skips by default
+        raise_on_status=False,
+    ),
+))
+
+# Loaded on first use by get_rembg_session
+_SESSION = None
+_RESIZER = Resizer() if Resizer else None
+
+
+def generate_card_id(word, card_type):
+    """Generate a unique card ID."""
+    short_uuid = str(uuid.uuid4())[:8]
+    prefix = "face-" if card_type == "face" else ""
+    return f"{prefix}{word.lower()}-{short_uuid}"
+
+
+def load_cards(data_file=DATA_FILE):
+    """Load existing cards from JSON."""
+    if data_file.exists():
+        with open(data_file, "rb") as f:
+            return orjson.loads(f.read())
+    return {"cards": []}
+
+
+def save_cards(data, data_file=DATA_FILE):
+    """Save cards to JSON, replacing the file atomically."""
+    tmp_path = data_file.with_suffix(".json.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, data_file)
+
+
+class Store:
+    """cards.json plus the Cloudflare Images account the cards live in.
+
+    The *_async card methods run the blocking ones in a thread, for the admin
+    server's event loop.
+    """
+
+    def __init__(self, data_file=DATA_FILE):
+        self.data_file = data_file
+
+        # cards.json is parsed once and kept in memory; it's only re-read when
+        # the file changes on disk (e.g. after another process adds a card).
+        # Cards are held in a dict keyed by id, in file order, so lookups and
+        # deletes are O(1)
+        self._cards = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+        # Created on first async upload, inside the running event loop
+        self._async_http = None
+
+    def _data_file_mtime(self):
+        return self.data_file.stat().st_mtime_ns if self.data_file.exists() else None
+
+    def _cached_cards(self):
+        """Return the in-memory cards keyed by id. Callers must hold _lock."""
+        mtime = self._data_file_mtime()
+        if self._cards is None or mtime != self._mtime:
+            self._cards = {card["id"]: card for card in load_cards(self.data_file)["cards"]}
+            self._mtime = mtime
+        return self._cards
+
+    def _persist(self):
+        """Write the in-memory cards to disk. Callers must hold _lock."""
+        try:
+            save_cards({"cards": list(self._cards.values())}, self.data_file)
+        except Exception:
+            # Memory no longer matches disk; reload on next access
+            self._cards = None
+            raise
+        self._mtime = self._data_file_mtime()
+
+    def cards(self):
+        """Return all cards as a list, in file order."""
+        with self._lock:
+            return list(self._cached_cards().values())
+
+    def add_card(self, card):
+        """Append a card and save; returns the new total."""
+        with self._lock:
+            cards = self._cached_cards()
+            cards[card["id"]] = card
+            self._persist()
+            return len(cards)
+
+    def delete_card(self, card_id):
+        """Delete a card and save; returns the new total, or None if not found."""
+        with self._lock:
+            cards = self._cached_cards()
+            if cards.pop(card_id, None) is None:
+                return None
+            self._persist()
+            return len(cards)
+
+    async def cards_async(self):
+        """Async cards()."""
+        return await asyncio.to_thread(self.cards)
+
+    async def add_card_async(self, card):
+        """Async add_card()."""
+        return await asyncio.to_thread(self.add_card, card)
+
+    async def delete_card_async(self, card_id):
+        """Async delete_card()."""
+        return await asyncio.to_thread(self.delete_card, card_id)
+
+    def upload_image(self, image_bytes, filename):
+        """Upload PNG bytes to Cloudflare Images; returns the delivery URL."""
+        url, headers = _cloudflare_request()
+        files = {
+            "file": (filename, image_bytes, "image/png")
+        }
+        response = _HTTP.post(url, headers=headers, files=files)
+        return _delivery_url(response)
+
+    async def upload_image_async(self, image_bytes, filename):
+        """Like upload_image, but awaits the network instead of blocking."""
+        import httpx
+
+        if self._async_http is None:
+            # The transport retries failed connects; 5xx responses are
+            # retried below
+            self._async_http = httpx.AsyncClient(
+                timeout=60.0,
+                transport=httpx.AsyncHTTPTransport(
+                    retries=CLOUDFLARE_RETRIES,
+                    limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+                ),
+            )
+
+        url, headers = _cloudflare_request()
+        files = {
+            "file": (filename, image_bytes, "image/png")
+        }
+        for attempt in range(CLOUDFLARE_RETRIES + 1):
+            response = await self._async_http.post(url, headers=headers, files=files)
+            if response.status_code not in CLOUDFLARE_RETRY_STATUSES or attempt == CLOUDFLARE_RETRIES:
+                break
+            await asyncio.sleep(0.5 * 2 ** attempt)
+        return _delivery_url(response)
+
+    async def aclose(self):
+        """Close the async HTTP client, if one was opened."""
+        if self._async_http is not None:
+            await self._async_http.aclose()
+            self._async_http = None
+
+    def remove_bg(self, image_path, box):
+        """Crop an image file and remove its background; returns an RGBA image."""
+        return crop_and_remove_backgrounds([(image_path, box)])[0]
+
+
+def _cloudflare_request():
+    """Return the Cloudflare Images upload URL and auth headers."""
+    account_id = os.environ.get("CLOUDFLARE_ACCOUNT_ID")
+    api_token = os.environ.get("CLOUDFLARE_API_TOKEN")
+
+    if not account_id or not api_token:
+        raise ValueError("CLOUDFLARE_ACCOUNT_ID and CLOUDFLARE_API_TOKEN must be set")
+
+    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/images/v1"
+
+    headers = {
+        "Authorization": f"Bearer {api_token}"
+    }
+    return url, headers
+
+
+def _delivery_url(response):
+    """Check a Cloudflare upload response and return the image's delivery URL."""
+    if response.status_code != 200:
+        raise Exception(f"Cloudflare upload failed: {response.text}")
+
+    result = response.json()
+    if not result.get("success"):
+        raise Exception(f"Cloudflare upload failed: {result.get('errors')}")
+
+    # Return the delivery URL with medium variant (good for cards - ~500px)
+    image_id = result["result"]["id"]
+    delivery_hash = os.environ.get("CLOUDFLARE_DELIVERY_HASH", "3oZsG34qPq3SIXQhl47vqA")
+
+    # Use 'medium' variant for optimal card size (retina-friendly but not excessive)
+    return f"https://imagedelivery.net/{delivery_hash}/{image_id}/medium"
+
+
+def _rembg_providers():
+    """Run rembg on the GPU when onnxruntime-gpu is installed, else on CPU."""
+    import onnxruntime
+
+    available = onnxruntime.get_available_providers()
+    return [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in available]
+
+
+def get_rembg_session():
+    """Return this process's rembg session, loading the model on first use."""
+    global _SESSION
+    if _SESSION is None:
+        from rembg import new_session
+
+        _SESSION = new_session(REMBG_MODEL, providers=_rembg_providers())
+    return _SESSION
+
+
+def resize_image(image, size):
+    """Lanczos resize, using cykooz.resizer's SIMD kernels when installed."""
+    if _RESIZER is None:
+        return image.resize(size, Image.LANCZOS)
+
+    resized = Image.new(image.mode, size)
+    _RESIZER.resize_pil(
+        image,
+        resized,
+        ResizeOptions(resize_alg=ResizeAlg.convolution(FilterType.lanczos3)),
+    )
+    return resized
+
+
+def fit_within(size, max_side):
+    """Scale (width, height) down to fit max_side, keeping the aspect ratio."""
+    width, height = size
+    scale = min(1.0, max_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def clamp_box(box, size):
+    """Clip a (left, upper, right, lower) box to an image of the given size."""
+    width, height = size
+    left, upper, right, lower = box
+    return (
+        min(max(left, 0), width),
+        min(max(upper, 0), height),
+        min(max(right, 0), width),
+        min(max(lower, 0), height),
+    )
+
+
+def draft_for_crop(img, box):
+    """Let JPEG decoding downscale by 1/2, 1/4 or 1/8 while the crop keeps at
+    least CROP_MIN_SIDE pixels on its longest side.
+
+    Must be called before the image is loaded. Returns the crop box scaled to
+    the reduced image (unchanged for formats without draft support).
+    """
+    scale = CROP_MIN_SIDE / max(box[2] - box[0], box[3] - box[1])
+    if scale >= 1:
+        return box
+
+    full_width, full_height = img.size
+    img.draft('RGB', (math.ceil(full_width * scale), math.ceil(full_height * scale)))
+    x_ratio = img.size[0] / full_width
+    y_ratio = img.size[1] / full_height
+    return (
+        round(box[0] * x_ratio),
+        round(box[1] * y_ratio),
+        round(box[2] * x_ratio),
+        round(box[3] * y_ratio),
+    )
+
+
+def predict_masks(images):
+    """Predict background masks, in a single model run when possible.
+
+    u2net models with a dynamic batch dimension get every image stacked into
+    one ONNX call; other models fall back to rembg one image at a time.
+    """
+    import numpy as np
+    from rembg import remove
+
+    session = get_rembg_session()
+    model_input = session.inner_session.get_inputs()[0]
+    if len(images) == 1 or REMBG_MODEL not in U2NET_MODELS or isinstance(model_input.shape[0], int):
+        return [remove(img, session=session, only_mask=True) for img in images]
+
+    # Same preprocessing and output scaling as rembg's U2netSession.predict
+    batch = np.concatenate([
+        session.normalize(img, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320))[model_input.name]
+        for img in images
+    ])
+    preds = session.inner_session.run(None, {model_input.name: batch})[0][:, 0, :, :]
+
+    masks = []
+    for img, pred in zip(images, preds):
+        pred = (pred - pred.min()) / (pred.max() - pred.min())
+        mask = Image.fromarray((pred * 255).astype("uint8"), mode="L")
+        masks.append(mask.resize(img.size, Image.LANCZOS))
+    return masks
+
+
+def crop_and_remove_backgrounds(crops):
+    """Crop images and remove their backgrounds.
+
+    Takes a list of (image_path, crop_box) pairs and returns RGBA images.
+    Crop boxes reaching past the image edges are clipped to the image; a box
+    with nothing left after clipping raises ValueError.
+    """
+    cropped_images = []
+    small_images = []
+    for image_path, box in crops:
+        with Image.open(image_path) as img:
+            clipped = clamp_box(box, img.size)
+            if clipped[2] <= clipped[0] or clipped[3] <= clipped[1]:
+                raise ValueError(f"Crop box {box} is outside the {img.size[0]}x{img.size[1]} image {image_path}")
+            box = draft_for_crop(img, clipped)
+            # Cut the crop out straight away so the full decoded source is
+            # released before the next image is opened
+            cropped = img.crop(box)
+        if cropped.mode not in ('RGB', 'RGBA'):
+            cropped = cropped.convert('RGBA')
+        cropped_images.append(cropped)
+        small = resize_image(cropped, fit_within(cropped.size, REMBG_MAX_SIDE))
+        # rembg's remove() applies the EXIF orientation to its input; drop it
+        # so masks come back in the same orientation as the crop
+        small.info.pop("exif", None)
+        small_images.append(small)
+
+    for cropped, mask in zip(cropped_images, predict_masks(small_images)):
+        cropped.putalpha(mask.resize(cropped.size, Image.BILINEAR))
+    return cropped_images
@@ -12,75 +12,18 @@ Example:
 Environment variables required:
     CLOUDFLARE_ACCOUNT_ID
     CLOUDFLARE_API_TOKEN
+
+Optional:
+    CLOUDFLARE_DELIVERY_HASH
 """
 
 import sys
 import os
-import json
-import uuid
-import requests
 from pathlib import Path
 from PIL import Image
 
-# Constants
-DATA_FILE = Path(__file__).parent.parent / "data" / "cards.json"
-
-
-def load_cards():
-    """Load existing cards from JSON."""
-    if DATA_FILE.exists():
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    return {"cards": []}
-
-
-def save_cards(data):
-    """Save cards to JSON."""
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
-
-
-def upload_to_cloudflare(image_path, filename):
-    """Upload image to Cloudflare Images."""
-    account_id = os.environ.get("CLOUDFLARE_ACCOUNT_ID")
-    api_token = os.environ.get("CLOUDFLARE_API_TOKEN")
-
-    if not account_id or not api_token:
-        raise ValueError("CLOUDFLARE_ACCOUNT_ID and CLOUDFLARE_API_TOKEN must be set")
-
-    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/images/v1"
-
-    headers = {
-        "Authorization": f"Bearer {api_token}"
-    }
-
-    with open(image_path, "rb") as f:
-        files = {
-            "file": (filename, f, "image/png")
-        }
-
-        print(f"Uploading to Cloudflare Images...")
-        response = requests.post(url, headers=headers, files=files)
-
-    if response.status_code != 200:
-        raise Exception(f"Cloudflare upload failed: {response.text}")
-
-    result = response.json()
-    if not result.get("success"):
-        raise Exception(f"Cloudflare upload failed: {result.get('errors')}")
-
-    # Return the delivery URL
-    image_id = result["result"]["id"]
-    variants = result["result"]["variants"]
-
-    # Use the public variant URL
-    return variants[0] if variants else f"https://imagedelivery.net/{account_id}/{image_id}/public"
-
-
-def generate_card_id(word):
-    """Generate a unique card ID for face cards."""
-    short_uuid = str(uuid.uuid4())[:8]
-    return f"face-{word.lower()}-{short_uuid}"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from card_store import Store, generate_card_id  # noqa: E402
 
 
 def main():
@@ -115,15 +58,15 @@ def main():
 
     # Upload to Cloudflare
     print("\nUploading to Cloudflare...")
-    card_id = generate_card_id(word)
+    store = Store()
+    card_id = generate_card_id(word, "face")
     filename = f"{card_id}.png"
-    image_url = upload_to_cloudflare(image_path, filename)
+    with open(image_path, "rb") as f:
+        image_url = store.upload_image(f.read(), filename)
     print(f"Uploaded! URL: {image_url}")
 
     # Update JSON
     print("Updating cards.json...")
-    cards_data = load_cards()
-
     new_card = {
         "id": card_id,
         "word": word,
@@ -131,11 +74,10 @@ def main():
         "type": "face"
     }
 
-    cards_data["cards"].append(new_card)
-    save_cards(cards_data)
+    total_cards = store.add_card(new_card)
 
     print(f"\nSuccess! Face card '{word}' added with ID: {card_id}")
-    print(f"Total cards: {len(cards_data['cards'])}")
+    print(f"Total cards: {total_cards}")
 
 
 if __name__ == "__main__":
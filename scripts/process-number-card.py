@@ -11,106 +11,25 @@ Example:
 Environment variables required:
     CLOUDFLARE_ACCOUNT_ID
     CLOUDFLARE_API_TOKEN
+
+Optional:
+    REMBG_MODEL (default: u2net, e.g. isnet-general-use or u2netp)
+    CLOUDFLARE_DELIVERY_HASH
 """
 
 import sys
 import os
-import json
-import uuid
-import requests
+import io
 from pathlib import Path
-from PIL import Image
-from rembg import remove
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from card_store import Store, generate_card_id  # noqa: E402
 
 # Constants
 CARD_ASPECT_RATIO = 2.5 / 3.5  # width / height
-DATA_FILE = Path(__file__).parent.parent / "data" / "cards.json"
 PROCESSED_DIR = Path(__file__).parent.parent / "processed"
 
 
-def load_cards():
-    """Load existing cards from JSON."""
-    if DATA_FILE.exists():
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    return {"cards": []}
-
-
-def save_cards(data):
-    """Save cards to JSON."""
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
-
-
-def crop_image(image_path, x, y, width, height):
-    """Crop image to specified region."""
-    img = Image.open(image_path)
-
-    # Ensure we're working with RGB or RGBA
-    if img.mode not in ('RGB', 'RGBA'):
-        img = img.convert('RGBA')
-
-    # Crop to specified region
-    cropped = img.crop((x, y, x + width, y + height))
-
-    return cropped
-
-
-def remove_background(image):
-    """Remove background from PIL Image."""
-    print("Removing background...")
-    output = remove(image)
-    return output
-
-
-def upload_to_cloudflare(image, filename):
-    """Upload image to Cloudflare Images."""
-    account_id = os.environ.get("CLOUDFLARE_ACCOUNT_ID")
-    api_token = os.environ.get("CLOUDFLARE_API_TOKEN")
-
-    if not account_id or not api_token:
-        raise ValueError("CLOUDFLARE_ACCOUNT_ID and CLOUDFLARE_API_TOKEN must be set")
-
-    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/images/v1"
-
-    headers = {
-        "Authorization": f"Bearer {api_token}"
-    }
-
-    # Save image to bytes
-    import io
-    img_bytes = io.BytesIO()
-    image.save(img_bytes, format='PNG')
-    img_bytes.seek(0)
-
-    files = {
-        "file": (filename, img_bytes, "image/png")
-    }
-
-    print(f"Uploading to Cloudflare Images...")
-    response = requests.post(url, headers=headers, files=files)
-
-    if response.status_code != 200:
-        raise Exception(f"Cloudflare upload failed: {response.text}")
-
-    result = response.json()
-    if not result.get("success"):
-        raise Exception(f"Cloudflare upload failed: {result.get('errors')}")
-
-    # Return the delivery URL
-    image_id = result["result"]["id"]
-    variants = result["result"]["variants"]
-
-    # Use the public variant URL
-    return variants[0] if variants else f"https://imagedelivery.net/{account_id}/{image_id}/public"
-
-
-def generate_card_id(word):
-    """Generate a unique card ID."""
-    short_uuid = str(uuid.uuid4())[:8]
-    return f"{word.lower()}-{short_uuid}"
-
-
 def main():
     if len(sys.argv) < 7:
         print("Usage: python process-number-card.py <image_path> <word> <crop_x> <crop_y> <crop_width> <crop_height>")
@@ -131,21 +50,20 @@ def main():
     print(f"Processing number card for word: {word}")
     print(f"Crop region: x={crop_x}, y={crop_y}, w={crop_width}, h={crop_height}")
 
-    # Step 1: Crop
-    print("Step 1: Cropping image...")
-    cropped = crop_image(image_path, crop_x, crop_y, crop_width, crop_height)
+    store = Store()
 
-    # Step 2: Remove background
-    print("Step 2: Removing background...")
-    processed = remove_background(cropped)
+    # Step 1: Crop and remove background
+    print("Step 1: Cropping image and removing background...")
+    box = (crop_x, crop_y, crop_x + crop_width, crop_y + crop_height)
+    processed = store.remove_bg(image_path, box)
 
     # Save processed image locally for preview
     PROCESSED_DIR.mkdir(exist_ok=True)
     preview_path = PROCESSED_DIR / f"{word.lower()}_preview.png"
-    processed.save(preview_path)
+    processed.save(preview_path, compress_level=1)  # fast; the upload is re-encoded
     print(f"Preview saved to: {preview_path}")
 
-    # Step 3: Ask for confirmation
+    # Step 2: Ask for confirmation
     print("\n" + "="*50)
     print(f"Preview saved to: {preview_path}")
     print("Please check the preview image.")
@@ -155,17 +73,17 @@ def main():
         print("Cancelled.")
         sys.exit(0)
 
-    # Step 4: Upload to Cloudflare
-    print("\nStep 3: Uploading to Cloudflare...")
-    card_id = generate_card_id(word)
+    # Step 3: Upload to Cloudflare
+    print("\nStep 2: Uploading to Cloudflare...")
+    card_id = generate_card_id(word, "number")
     filename = f"{card_id}.png"
-    image_url = upload_to_cloudflare(processed, filename)
+    img_bytes = io.BytesIO()
+    processed.save(img_bytes, format='PNG')
+    image_url = store.upload_image(img_bytes.getvalue(), filename)
     print(f"Uploaded! URL: {image_url}")
 
-    # Step 5: Update JSON
-    print("Step 4: Updating cards.json...")
-    cards_data = load_cards()
-
+    # Step 4: Update JSON
+    print("Step 3: Updating cards.json...")
     new_card = {
         "id": card_id,
         "word": word,
@@ -173,11 +91,10 @@ def main():
         "type": "number"
     }
 
-    cards_data["cards"].append(new_card)
-    save_cards(cards_data)
+    total_cards = store.add_card(new_card)
 
     print(f"\nSuccess! Card '{word}' added with ID: {card_id}")
-    print(f"Total cards: {len(cards_data['cards'])}")
+    print(f"Total cards: {total_cards}")
 
 
 if __name__ == "__main__":